@@ -1,27 +1,224 @@
 #!/usr/bin/env python3
 import argparse
-import json
-import logging
+import atexit
+import collections
+import functools
+import gzip
+import os
 import sys
+import threading
 import time
+import traceback
 
+import orjson
 from ldclient import LDClient, Config, Context   # ✅ proper LD imports
 from ldclient.hook import Hook, Metadata        # ✅ hooks API (Python SDK v9+)
 
 
-# ---- JSON logger to stdout (Dynatrace picks this up via OneAgent/Operator)
-logger = logging.getLogger("ld-json")
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(logging.Formatter("%(message)s"))  # emit raw JSON lines
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+# ---- JSON lines to stdout (Dynatrace picks this up via OneAgent/Operator)
+# Written straight to the binary stdout buffer: one format, one destination, so
+# the logging module's record/formatter/handler machinery is pure overhead here.
+# Lines are queued and written in batches by a background thread, so a hook never
+# blocks on a slow stdout reader and a burst of evaluations costs one write.
+_STDOUT = sys.stdout.buffer
+_out = _STDOUT
+_log_file = None        # file opened by open_log_file(), if any
+_lock = threading.Lock()
+_pending = collections.deque()
+_wakeup = threading.Event()
+_FLUSH_INTERVAL = 0.1   # seconds between background flushes
+_FLUSH_THRESHOLD = 256  # queued lines that trigger an early flush
+_MAX_PENDING = 10_000   # queued lines kept while the sink is stalled; newer lines are dropped
+_dropped = 0            # lines dropped since the last successful write
+_broken = False         # the sink hit a broken pipe; output is discarded from then on
+_needs_flush = False    # lines were written but the sink's flush failed
+_ERROR_REPORT_INTERVAL = 60.0  # seconds between write-error tracebacks on stderr
+_last_error_report = float("-inf")
+_suppressed_errors = 0
+
+
+def _encode_json(payload: dict) -> bytes:
+    return orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE)
+
+
+_encode = _encode_json
+
+
+def set_log_format(fmt: str):
+    """
+    Choose the wire format for log lines: "json" (newline-delimited, the default)
+    or "msgpack" (self-delimiting binary frames; needs the optional msgpack package).
+    """
+    global _encode
+    if fmt == "json":
+        _encode = _encode_json
+    elif fmt == "msgpack":
+        import msgpack  # optional dependency, only needed for binary output
+        _encode = functools.partial(msgpack.packb, use_bin_type=True)
+    else:
+        raise ValueError(f"Unknown log format: {fmt}")
+
+
+def json_log_raw(payload: dict):
+    """
+    Queue a payload that already carries every field, including "source" and
+    "timestamp", for trusted callers that skip json_log's defaults.
+    """
+    _enqueue(_encode(payload))
+
+
+def _enqueue(line: bytes):
+    global _dropped
+    if _broken or len(_pending) >= _MAX_PENDING:
+        _dropped += 1
+        return
+    _pending.append(line)
+    if len(_pending) >= _FLUSH_THRESHOLD:
+        _wakeup.set()
+
+
+def flush_logs():
+    """
+    Write every queued line to stdout and flush it.
+    Called periodically by the background thread and on shutdown.
+    Write errors are reported on stderr rather than raised, like logging's
+    Handler.handleError, and the unwritten lines are kept for the next try.
+    A broken pipe means the reader is gone for good, so output stops there.
+    """
+    global _dropped, _needs_flush
+    with _lock:
+        if _broken or not (_pending or _needs_flush):
+            return
+        lines = [_pending.popleft() for _ in range(len(_pending))]
+        if lines:
+            # Assemble the batch in one growing buffer and hand it over in one write
+            buf = bytearray()
+            for line in lines:
+                buf += line
+            try:
+                _out.write(buf)
+            except BrokenPipeError:
+                _close_broken_sink(len(lines))
+                return
+            except Exception as exc:
+                _requeue_unwritten(lines, getattr(exc, "characters_written", 0))
+                _report_write_error()
+                return
+        try:
+            # The bytes are already in the sink's buffer, so a failed flush isn't
+            # rewritten; _needs_flush makes the next call retry it even if idle
+            _out.flush()
+            _needs_flush = False
+        except BrokenPipeError:
+            _close_broken_sink(0)
+            return
+        except Exception:
+            _needs_flush = True
+            _report_write_error()
+            return
+        if _dropped:
+            sys.stderr.write(f"ld_eval_to_logs: dropped {_dropped} log lines while the output was stalled\n")
+            _dropped = 0
+
+
+def _requeue_unwritten(lines: list, written: int):
+    # Put back the lines (or the tail of the line) the sink didn't take, ahead of
+    # anything queued since, then trim the newest lines to stay within _MAX_PENDING
+    global _dropped
+    for i, line in enumerate(lines):
+        if written < len(line):
+            unwritten = [line[written:]] + lines[i + 1:]
+            break
+        written -= len(line)
+    else:
+        unwritten = []
+    _pending.extendleft(reversed(unwritten))
+    while len(_pending) > _MAX_PENDING:
+        _pending.pop()
+        _dropped += 1
+
+
+def _close_broken_sink(lost: int):
+    global _broken, _dropped
+    _broken = True
+    _dropped += lost + len(_pending)
+    _pending.clear()
+    sys.stderr.write("ld_eval_to_logs: log output closed (broken pipe); discarding further log lines\n")
+    if _out is _STDOUT:
+        # Point stdout at /dev/null so the interpreter's own flush at exit
+        # doesn't hit the broken pipe again
+        try:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), _STDOUT.fileno())
+        except OSError:
+            pass
+
+
+def _report_write_error():
+    # At most one traceback per _ERROR_REPORT_INTERVAL; a sink that keeps failing
+    # would otherwise print one every _FLUSH_INTERVAL
+    global _last_error_report, _suppressed_errors
+    now = time.monotonic()
+    if now - _last_error_report < _ERROR_REPORT_INTERVAL:
+        _suppressed_errors += 1
+        return
+    _last_error_report = now
+    sys.stderr.write("--- ld_eval_to_logs: log write failed ---\n")
+    if _suppressed_errors:
+        sys.stderr.write(f"({_suppressed_errors} more failures since the last report)\n")
+        _suppressed_errors = 0
+    traceback.print_exc(file=sys.stderr)
+
+
+def open_log_file(path: str):
+    """
+    Send log lines to a file instead of stdout.
+    Paths ending in '.gz' are gzip-compressed; level 1 keeps CPU low while still
+    shrinking the heavily repeated JSON keys.
+    """
+    global _out, _log_file, _broken, _needs_flush
+    sink = gzip.open(path, "ab", compresslevel=1) if path.endswith(".gz") else open(path, "ab")
+    close_log_file()
+    with _lock:
+        _out = _log_file = sink
+        _broken = _needs_flush = False
+
+
+def close_log_file():
+    """Flush queued lines and close the log file, if one is open."""
+    global _out, _log_file, _needs_flush
+    flush_logs()
+    with _lock:
+        if _log_file is not None:
+            _log_file.close()
+            _out = _STDOUT
+            _log_file = None
+            _needs_flush = False
+
+
+def _flush_loop():
+    while True:
+        _wakeup.wait(_FLUSH_INTERVAL)
+        _wakeup.clear()
+        flush_logs()
+
+
+threading.Thread(target=_flush_loop, name="ld-json-flush", daemon=True).start()
+atexit.register(close_log_file)
 
 
 def json_log(payload: dict):
-    payload.setdefault("timestamp", int(time.time() * 1000))
+    payload.setdefault("timestamp", time.time_ns() // 1_000_000)
     payload.setdefault("source", "LaunchDarkly")
     # Don't set default event name - let callers specify it
-    logger.info(json.dumps(payload, separators=(",", ":"), ensure_ascii=False))
+    json_log_raw(payload)
+
+
+# ---- Hook output switch: LD_EVAL_LOG_EVALUATIONS=0/false/off/no turns the per-evaluation
+# lines off, leaving the hook installed but nearly free (status/summary lines still emit)
+_EMIT = os.environ.get("LD_EVAL_LOG_EVALUATIONS", "1").strip().lower() not in ("0", "false", "off", "no")
+
+
+_KEY_ESCAPES = str.maketrans({'%': '%25', ':': '%3A'})
 
 
 def encode_key(key: str) -> str:
@@ -30,7 +227,7 @@ def encode_key(key: str) -> str:
     Encodes '%' and ':' characters as they're used as delimiters.
     """
     if '%' in key or ':' in key:
-        return key.replace('%', '%25').replace(':', '%3A')
+        return key.translate(_KEY_ESCAPES)
     return key
 
 
@@ -43,113 +240,158 @@ def get_canonical_key(context) -> str:
     try:
         if context.multiple:
             # Multi-kind context
+            # Alternating kind/key tokens, joined once; the SDK keeps the
+            # individual contexts sorted by kind, so no sort is needed here
             parts = []
-            for kind in sorted(context.kinds()):
-                ctx = context.get(kind)
+            append = parts.append
+            for i in range(context.individual_context_count):
+                ctx = context.get_individual_context(i)
                 if ctx and hasattr(ctx, 'key'):
-                    parts.append(f"{kind}:{encode_key(ctx.key)}")
+                    append(ctx.kind)
+                    append(encode_key(ctx.key))
             return ":".join(parts) if parts else encode_key(context.key)
         else:
             # Single context
             encoded_key = encode_key(context.key)
             if context.kind and context.kind != "user":
-                return f"{context.kind}:{encoded_key}"
+                return context.kind + ":" + encoded_key
             return encoded_key
     except Exception:
         return str(context)
 
 
+# ---- Per-context summaries, reused across flags and before/after hooks.
+# Contexts aren't hashable, so entries are keyed by id() and keep a reference to
+# the context itself; that pins the id and lets a lookup confirm it's the same object.
+_context_cache = {}
+_CONTEXT_CACHE_SIZE = 1024
+
+
+def describe_context(context) -> dict:
+    """
+    Build the lightweight "context" field of a log payload: kinds, canonical key,
+    and the key for single-kind contexts. Results are cached per Context object.
+    """
+    cached = _context_cache.get(id(context))
+    if cached is not None and cached[0] is context:
+        return cached[1]
+
+    # Get canonical context key for tracking
+    canonical_key = get_canonical_key(context)
+
+    # Try to keep context lightweight to avoid PII; include kind/key only
+    try:
+        # Context API: pull "kind" and "key" safely
+        if context.multiple:
+            # Already sorted by kind (see get_canonical_key)
+            kinds = tuple(context.get_individual_context(i).kind
+                          for i in range(context.individual_context_count))
+            ctx_repr = {"kinds": kinds, "canonicalKey": canonical_key}
+        else:
+            kinds = (context.kind,)
+            ctx_repr = {"kinds": kinds, "canonicalKey": canonical_key}
+
+        # Try to include a stable key if present (avoid dumping all attributes)
+        # NOTE: For multi-kind, there may be multiple keys; keep it minimal.
+        if not context.multiple and context.key is not None:
+            ctx_repr["key"] = context.key
+    except Exception:
+        ctx_repr = {"repr": str(context)}
+
+    if len(_context_cache) >= _CONTEXT_CACHE_SIZE:
+        _context_cache.clear()
+    _context_cache[id(context)] = (context, ctx_repr)
+    return ctx_repr
+
+
+# ---- Optional evaluation reason fields: (attribute name, Dynatrace/SDK dict key)
+_REASON_FIELDS = (
+    ("rule_id", "ruleId"),
+    ("rule_index", "ruleIndex"),
+    ("in_experiment", "inExperiment"),
+    ("error_kind", "errorKind"),
+    ("prerequisite_key", "prerequisiteKey"),
+)
+_REASON_ATTRS = ("kind",) + tuple(name for name, _ in _REASON_FIELDS)
+
+
+def reason_to_dict(reason) -> dict:
+    """
+    Flatten an evaluation reason into the Dynatrace template's reason fields.
+    The SDK hands reasons over as dicts already keyed in camelCase; objects with
+    snake_case attributes are read through __dict__, or getattr for __slots__ types.
+    """
+    if isinstance(reason, dict):
+        reason_dict = {"kind": reason.get("kind")}
+        for _, key in _REASON_FIELDS:
+            value = reason.get(key)
+            if value is not None:
+                reason_dict[key] = value
+        return reason_dict
+
+    try:
+        attrs = reason.__dict__
+    except AttributeError:
+        attrs = {name: getattr(reason, name, None) for name in _REASON_ATTRS}
+    reason_dict = {"kind": attrs.get("kind")}
+    for name, key in _REASON_FIELDS:
+        value = attrs.get(name)
+        if value is not None:
+            reason_dict[key] = value
+    return reason_dict
+
+
 # ---- Hook that logs after each flag evaluation
 class EvaluationLoggingHook(Hook):
-    @property
-    def metadata(self) -> Metadata:
-        return Metadata(name="evaluation-logging-hook")
+    # Plain class attribute: satisfies the abstract property without building
+    # a new Metadata every time the SDK reads it
+    metadata = Metadata(name="evaluation-logging-hook")
 
     def before_evaluation(self, series_context, data):
+        if not _EMIT:
+            return data
+
         # Extract context and flag key from series_context
         context = series_context.context
         flag_key = series_context.key
         default_value = series_context.default_value
         method = series_context.method
         
-        # Get canonical context key for tracking
-        canonical_key = get_canonical_key(context)
-        
-        # Try to keep context lightweight to avoid PII; include kind/key only
-        try:
-            # Context API: pull "kind" and "key" safely
-            if context.multiple:
-                kinds = sorted([k for k in context.kinds()])
-                ctx_repr = {"kinds": kinds, "canonicalKey": canonical_key}
-            else:
-                kinds = [context.kind]
-                ctx_repr = {"kinds": kinds, "canonicalKey": canonical_key}
-
-            # Try to include a stable key if present (avoid dumping all attributes)
-            if not context.multiple and context.key is not None:
-                ctx_repr["key"] = context.key
-        except Exception:
-            ctx_repr = {"repr": str(context)}
+        ctx_repr = describe_context(context)
 
-        payload = {
+        # Complete payload in one literal, so it goes straight to json_log_raw
+        json_log_raw({
+            "source": "LaunchDarkly",
             "event": "before_flag_evaluation",
+            "timestamp": time.time_ns() // 1_000_000,
             "flagKey": flag_key,
             "defaultValue": default_value,
             "method": method,
             "context": ctx_repr,
-        }
-        json_log(payload)
+        })
         
         return data  # Return the data dict as required
 
     # Signature per LD Python SDK v9+
     def after_evaluation(self, series_context, data, detail):
+        if not _EMIT:
+            return data
+
         # Extract context and flag key from series_context
         context = series_context.context
         flag_key = series_context.key
         method = series_context.method
         
-        # Get canonical context key for tracking
-        canonical_key = get_canonical_key(context)
-        
-        # Try to keep context lightweight to avoid PII; include kind/key only
-        try:
-            # Context API: pull "kind" and "key" safely
-            if context.multiple:
-                kinds = sorted([k for k in context.kinds()])
-                ctx_repr = {"kinds": kinds, "canonicalKey": canonical_key}
-            else:
-                kinds = [context.kind]
-                ctx_repr = {"kinds": kinds, "canonicalKey": canonical_key}
-
-            # Try to include a stable key if present (avoid dumping all attributes)
-            # NOTE: For multi-kind, there may be multiple keys; keep it minimal.
-            if not context.multiple and context.key is not None:
-                ctx_repr["key"] = context.key
-        except Exception:
-            ctx_repr = {"repr": str(context)}
+        ctx_repr = describe_context(context)
 
         # Extract detailed reason information (matching Dynatrace template format)
         reason = getattr(detail, "reason", None)
-        reason_dict = None
-        if reason:
-            reason_dict = {
-                "kind": getattr(reason, "kind", None),
-            }
-            # Add optional reason fields if present
-            if hasattr(reason, "rule_id") and reason.rule_id is not None:
-                reason_dict["ruleId"] = reason.rule_id
-            if hasattr(reason, "rule_index") and reason.rule_index is not None:
-                reason_dict["ruleIndex"] = reason.rule_index
-            if hasattr(reason, "in_experiment") and reason.in_experiment is not None:
-                reason_dict["inExperiment"] = reason.in_experiment
-            if hasattr(reason, "error_kind") and reason.error_kind is not None:
-                reason_dict["errorKind"] = reason.error_kind
-            if hasattr(reason, "prerequisite_key") and reason.prerequisite_key is not None:
-                reason_dict["prerequisiteKey"] = reason.prerequisite_key
-
-        payload = {
+        reason_dict = reason_to_dict(reason) if reason else None
+
+        json_log_raw({
+            "source": "LaunchDarkly",
             "event": "after_flag_evaluation",
+            "timestamp": time.time_ns() // 1_000_000,
             "flagKey": flag_key,
             "value": getattr(detail, "value", None),
             "variationIndex": getattr(detail, "variation_index", None),
@@ -157,12 +399,39 @@ class EvaluationLoggingHook(Hook):
             "method": method,
             "reason": reason_dict,
             "context": ctx_repr,
-        }
-        json_log(payload)
+        })
         
         return data  # Return the data dict as required
 
 
+# ---- Library entry points: reuse contexts across evaluations
+_contexts = {}
+
+
+def get_context(user_key: str, project: str) -> Context:
+    """
+    Return the minimal, privacy-safe context for a user, tagged with the project.
+    Contexts are built once per (user_key, project) and reused, which also lets
+    the hook's per-context cache hit on every later evaluation.
+    """
+    context = _contexts.get((user_key, project))
+    if context is None:
+        ctx_builder = Context.builder(user_key)  # ✅ best practice: builder API
+        ctx_builder.set("project", project)      # tag for dashboards/search
+        context = ctx_builder.build()
+        if len(_contexts) >= _CONTEXT_CACHE_SIZE:
+            _contexts.clear()
+        _contexts[(user_key, project)] = context
+    return context
+
+
+def evaluate_flag(client: LDClient, context: Context, flag_key: str, default):
+    """
+    Evaluate a flag for a prebuilt context; the hook emits the JSON log lines.
+    """
+    return client.variation(flag_key, context, default)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Evaluate an LD flag and log to stdout (for Dynatrace).")
     parser.add_argument("--sdk-key", required=True, help="LaunchDarkly server-side SDK key (environment-specific).")
@@ -173,8 +442,20 @@ def main():
                         help="Default value if flag not found (bool). Default: false.")
     parser.add_argument("--simulate-down", action="store_true",
                         help="Simulate LaunchDarkly being down (uses invalid endpoints for testing).")
+    parser.add_argument("--log-file",
+                        help="Append log output (JSON lines or msgpack frames) to this file instead of stdout; gzip-compressed if it ends in .gz.")
+    parser.add_argument("--format", default="json", choices=["json", "msgpack"],
+                        help="Log encoding: newline-delimited JSON, or MessagePack frames (needs msgpack). Default: json.")
     args = parser.parse_args()
 
+    try:
+        set_log_format(args.format)
+    except ImportError:
+        parser.error("--format msgpack requires the msgpack package (pip install msgpack)")
+
+    if args.log_file:
+        open_log_file(args.log_file)
+
     default_value = True if args.default.lower() == "true" else False
 
     # ---- LD client config (streaming on; events enabled by default)
@@ -190,11 +471,10 @@ def main():
             hooks=[EvaluationLoggingHook()],
             initial_reconnect_delay=0.1  # Fail fast for testing
         )
-        logger.info(json.dumps({
-            "source": "LaunchDarkly",
+        json_log({
             "event": "simulation_mode",
             "message": "Simulating LaunchDarkly down - using invalid endpoints"
-        }, separators=(",", ":")))
+        })
     else:
         config = Config(sdk_key=args.sdk_key, stream=True, offline=False, hooks=[EvaluationLoggingHook()])
     
@@ -205,7 +485,6 @@ def main():
         data_source_status = client.data_source_status_provider.status
         
         status_payload = {
-            "source": "LaunchDarkly",
             "event": "data_source_status",
             "state": str(data_source_status.state.name) if hasattr(data_source_status.state, 'name') else str(data_source_status.state),
             "stateSince": int(data_source_status.since * 1000) if data_source_status.since else None,  # Convert to milliseconds
@@ -220,28 +499,27 @@ def main():
                 "time": int(error_info.time * 1000) if hasattr(error_info, 'time') and error_info.time else None,
             }
         
-        logger.info(json.dumps(status_payload, separators=(",", ":")))
+        json_log(status_payload)
         
         # ---- Minimal, privacy-safe context; attach project as an attribute
-        ctx_builder = Context.builder(args.user_key)  # ✅ best practice: builder API
-        ctx_builder.set("project", args.project)      # tag for dashboards/search
-        context = ctx_builder.build()
+        context = get_context(args.user_key, args.project)
 
         # ---- Evaluate once (this will trigger the hook and emit a JSON log line)
-        value = client.variation(args.flag_key, context, default_value)
+        value = evaluate_flag(client, context, args.flag_key, default_value)
 
         # Also print a small human hint (optional)
-        logger.info(json.dumps({
-            "source": "LaunchDarkly",
+        json_log({
             "event": "evaluation_result_summary",
             "flagKey": args.flag_key,
             "value": value,
             "project": args.project
-        }, separators=(",", ":"), ensure_ascii=False))
+        })
 
     finally:
-        # Flush any pending events & close cleanly
+        # Write out queued log lines, then flush any pending events & close cleanly
+        flush_logs()
         client.close()
+        close_log_file()
 
 
 if __name__ == "__main__":
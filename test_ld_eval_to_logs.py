@@ -0,0 +1,181 @@
+import collections
+import gzip
+import json
+
+import pytest
+from ldclient import Context
+
+import ld_eval_to_logs as m
+
+# The background thread calls m.flush_logs by name; the fixture below swaps that
+# for a no-op so the tests drive every flush themselves through this reference.
+flush = m.flush_logs
+
+
+class FailingSink:
+    """Sink whose write() raises `error` for the first `failures` calls (all calls if None)."""
+
+    def __init__(self, error, failures=None, partial=0):
+        self.error = error
+        self.failures = failures
+        self.partial = partial  # bytes accepted by the first failing write
+        self.calls = 0
+        self.data = bytearray()
+        self.flushes = 0
+
+    def write(self, buf):
+        self.calls += 1
+        if self.failures is None or self.calls <= self.failures:
+            written = self.partial if self.calls == 1 else 0
+            self.data += buf[:written]
+            exc = self.error()
+            exc.characters_written = written
+            raise exc
+        self.data += buf
+        return len(buf)
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    """Isolate the writer's module state; returns a setter for the sink."""
+    monkeypatch.setattr(m, "flush_logs", lambda: None)
+    monkeypatch.setattr(m, "_pending", collections.deque())
+    monkeypatch.setattr(m, "_dropped", 0)
+    monkeypatch.setattr(m, "_broken", False)
+    monkeypatch.setattr(m, "_needs_flush", False)
+    monkeypatch.setattr(m, "_last_error_report", float("-inf"))
+    monkeypatch.setattr(m, "_suppressed_errors", 0)
+
+    def use(out):
+        monkeypatch.setattr(m, "_out", out)
+        return out
+    return use
+
+
+def lines_of(data):
+    return [json.loads(line) for line in bytes(data).decode().splitlines()]
+
+
+def test_failing_sink_keeps_queue_bounded(sink, monkeypatch):
+    sink(FailingSink(OSError))
+    monkeypatch.setattr(m, "_MAX_PENDING", 50)
+    for _ in range(4):
+        for i in range(50):
+            m.json_log({"event": "x", "i": i})
+        flush()
+
+    assert len(m._pending) <= 50
+    assert sum(len(line) for line in m._pending) < 50 * 100
+    assert len(m._pending) + m._dropped == 200
+
+
+def test_partial_write_is_resumed_without_duplicates(sink):
+    out = sink(FailingSink(BlockingIOError, failures=1, partial=7))
+    for i in range(5):
+        m.json_log({"event": "x", "i": i})
+    flush()
+    flush()
+
+    assert [p["i"] for p in lines_of(out.data)] == [0, 1, 2, 3, 4]
+    assert not m._pending
+
+
+def test_dropped_lines_are_counted_and_reported(sink, monkeypatch, capsys):
+    out = sink(FailingSink(OSError, failures=1))
+    monkeypatch.setattr(m, "_MAX_PENDING", 3)
+    for i in range(5):
+        m.json_log({"event": "x", "i": i})
+    flush()
+    flush()
+
+    assert [p["i"] for p in lines_of(out.data)] == [0, 1, 2]
+    assert m._dropped == 0
+    assert "dropped 2 log lines" in capsys.readouterr().err
+
+
+def test_broken_pipe_stops_output(sink):
+    out = sink(FailingSink(BrokenPipeError))
+    m.json_log({"event": "x"})
+    flush()
+    m.json_log({"event": "y"})
+    flush()
+
+    assert m._broken
+    assert not m._pending
+    assert out.calls == 1
+
+
+def test_failed_flush_is_retried_when_idle(sink):
+    class FlakyFlush(FailingSink):
+        def flush(self):
+            self.flushes += 1
+            if self.flushes == 1:
+                raise OSError("disk full")
+
+    out = sink(FlakyFlush(OSError, failures=0))
+    m.json_log({"event": "x"})
+    flush()
+    assert m._needs_flush
+
+    flush()
+    assert not m._needs_flush
+    assert out.flushes == 2
+    assert len(lines_of(out.data)) == 1
+
+
+@pytest.mark.parametrize("name,reader", [("out.log", open), ("out.log.gz", gzip.open)])
+def test_log_file_round_trip(sink, tmp_path, name, reader):
+    sink(m._STDOUT)
+    path = str(tmp_path / name)
+    m.open_log_file(path)
+    m.json_log({"event": "x", "i": 1})
+    flush()
+    m.close_log_file()
+
+    assert m._out is m._STDOUT
+    assert m._log_file is None
+    with reader(path, "rb") as f:
+        (payload,) = lines_of(f.read())
+    assert isinstance(payload.pop("timestamp"), int)
+    assert payload == {"event": "x", "i": 1, "source": "LaunchDarkly"}
+
+
+def test_reason_to_dict_from_sdk_dict():
+    reason = {"kind": "RULE_MATCH", "ruleIndex": 0, "ruleId": "r1", "inExperiment": None}
+    assert m.reason_to_dict(reason) == {"kind": "RULE_MATCH", "ruleId": "r1", "ruleIndex": 0}
+
+
+def test_reason_to_dict_from_objects():
+    class Reason:
+        def __init__(self):
+            self.kind = "ERROR"
+            self.error_kind = "FLAG_NOT_FOUND"
+
+    class SlotsReason:
+        __slots__ = ("kind", "prerequisite_key")
+
+        def __init__(self):
+            self.kind = "PREREQUISITE_FAILED"
+            self.prerequisite_key = "other-flag"
+
+    assert m.reason_to_dict(Reason()) == {"kind": "ERROR", "errorKind": "FLAG_NOT_FOUND"}
+    assert m.reason_to_dict(SlotsReason()) == {"kind": "PREREQUISITE_FAILED", "prerequisiteKey": "other-flag"}
+
+
+def test_canonical_key_escapes_and_kinds():
+    assert m.get_canonical_key(Context.create("user:1%x")) == "user%3A1%25x"
+    assert m.get_canonical_key(Context.create("org-1", "organization")) == "organization:org-1"
+
+
+def test_describe_context_multi_kind():
+    context = Context.create_multi(Context.create("u:2"), Context.create("org-1", "organization"))
+    ctx_repr = m.describe_context(context)
+
+    assert ctx_repr == {"kinds": ("organization", "user"), "canonicalKey": "organization:org-1:user:u%3A2"}
+    assert m.describe_context(context) is ctx_repr